@@ -6,7 +6,6 @@ Main Entry Point
 
 import os
 import sys
-import time
 import argparse
 import threading
 from pathlib import Path
@@ -14,15 +13,7 @@ from pathlib import Path
 # Add src/ to path for package imports
 sys.path.insert(0, str(Path(__file__).parent / "src"))
 
-# Early argument parsing to get StreamDiffusion path before imports
-def get_streamdiffusion_path():
-    """Parse args early to get StreamDiffusion path"""
-    parser = argparse.ArgumentParser(add_help=False)
-    parser.add_argument('--streamdiffusion-path', type=str, default=None)
-    args, _ = parser.parse_known_args()
-    return args.streamdiffusion_path
-
-# Add StreamDiffusion utils to path BEFORE importing our modules
+# Add StreamDiffusion utils to path BEFORE importing the diffusion engine
 # Priority: 1. --streamdiffusion-path arg, 2. STREAMDIFFUSION_PATH env, 3. ../StreamDiffusion
 def add_streamdiffusion_to_path(custom_path=None):
     """Add StreamDiffusion utils directory to Python path"""
@@ -43,18 +34,9 @@ def add_streamdiffusion_to_path(custom_path=None):
         print(f"Please set --streamdiffusion-path or STREAMDIFFUSION_PATH environment variable")
         sys.exit(1)
 
-# Add StreamDiffusion to path early
-try:
-    custom_path = get_streamdiffusion_path()
-    utils_path = add_streamdiffusion_to_path(custom_path)
-except SystemExit:
-    raise
-
-# Now import our modules (after StreamDiffusion is in path)
+# Only the lightweight config module is imported up front, so --help and
+# argument errors return without importing StreamDiffusion or python-osc
 from streamdiffusion_spout_service import config
-from streamdiffusion_spout_service.osc_server import start_osc_server
-from streamdiffusion_spout_service.diffusion_engine import start_diffusion_thread
-from streamdiffusion_spout_service.utils import parse_lora_string
 
 def main():
     """Main entry point for the service"""
@@ -70,6 +52,8 @@ def main():
                         help=f'Spout receiver name (default: {config.DEFAULT_SPOUT_RECEIVER_NAME})')
     parser.add_argument('--spout-out', type=str, default=config.DEFAULT_SPOUT_SENDER_NAME,
                         help=f'Spout sender name (default: {config.DEFAULT_SPOUT_SENDER_NAME})')
+    parser.add_argument('--spout-format', type=str, default='rgba', choices=['rgba', 'bgra'],
+                        help='Spout pixel format; bgra matches most Windows GL drivers (default: rgba)')
     parser.add_argument('--model', type=str, default=config.DEFAULT_MODEL_ID,
                         help=f'Model ID or path (default: {config.DEFAULT_MODEL_ID})')
     parser.add_argument('--lora', type=str, default=None,
@@ -83,45 +67,51 @@ def main():
                         help='Acceleration method (default: xformers)')
     parser.add_argument('--delta', type=float, default=0.5,
                         help='Delta multiplier of virtual residual noise (default: 0.5)')
+    parser.add_argument('--frame-buffer-size', type=int, default=1,
+                        help='Frames batched per denoising call; /trigger outputs once this many frames are received (default: 1)')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='StreamDiffusion wrapper warmup iterations (default: 2)')
+    parser.add_argument('--num-inference-steps', type=int, default=50,
+                        help='Timestep schedule length, at least 46 for the built-in t_index_list (default: 50)')
+    parser.add_argument('--compile-mode', type=str, default='reduce-overhead',
+                        choices=['none', 'default', 'reduce-overhead', 'max-autotune'],
+                        help='torch.compile mode for the UNet, ignored with tensorrt (default: reduce-overhead)')
     parser.add_argument('--verbose', type=int, default=config.DEFAULT_VERBOSE, choices=[0, 1, 2, 3],
                         help='Verbose level: 0=quiet, 1=startup/shutdown, 2=+OSC, 3=+prompts/frames (default: 1)')
     parser.add_argument('--quiet', action='store_true',
                         help='Set verbose to 0 (overrides --verbose)')
     
     args = parser.parse_args()
-
-    # StreamDiffusion path already added at startup
-    if config.verbose >= 2:
-        print(f"Using StreamDiffusion utils from: {utils_path}")
+    if args.frame_buffer_size < 1:
+        parser.error('--frame-buffer-size must be at least 1')
+    if args.warmup < 0:
+        parser.error('--warmup must not be negative')
 
     # Set verbose level based on arguments
     if args.quiet:
         config.verbose = 0
     else:
         config.verbose = args.verbose
+
+    # Add StreamDiffusion to path before the diffusion engine is imported
+    utils_path = add_streamdiffusion_to_path(args.streamdiffusion_path)
+    if config.verbose >= 2:
+        print(f"Using StreamDiffusion utils from: {utils_path}")
     
-    # Parse LoRA dict if provided
-    lora_dict = parse_lora_string(args.lora) if args.lora else None
+    # Parse LoRA dict if provided (utils pulls in numpy/PIL, so import on demand)
+    lora_dict = None
+    if args.lora:
+        from streamdiffusion_spout_service.utils import parse_lora_string
+        lora_dict = parse_lora_string(args.lora)
     
+    from streamdiffusion_spout_service.osc_server import start_osc_server
+
     # Create and start threads
     osc_thread = threading.Thread(
         target=start_osc_server,
         args=(args.osc_ip, args.osc_port)
     )
-    
-    sd_thread = threading.Thread(
-        target=start_diffusion_thread,
-        args=(
-            args.model,
-            lora_dict,
-            args.width,
-            args.height,
-            args.spout_in,
-            args.spout_out,
-            args.acceleration,
-            args.delta,
-        )
-    )
+    sd_thread = None
     
     try:
         if config.verbose >= 1:
@@ -134,20 +124,47 @@ def main():
             print("      - Config attribute warnings - Model compatibility notices")
             print()
         osc_thread.start()
+
+        # Import the diffusion engine only after OSC is listening, so the
+        # torch/diffusers import cost does not delay OSC responsiveness
+        from streamdiffusion_spout_service.diffusion_engine import start_diffusion_thread
+
+        sd_thread = threading.Thread(
+            target=start_diffusion_thread,
+            args=(
+                args.model,
+                lora_dict,
+                args.width,
+                args.height,
+                args.spout_in,
+                args.spout_out,
+                args.acceleration,
+                args.delta,
+                args.compile_mode,
+                args.frame_buffer_size,
+                args.warmup,
+                args.num_inference_steps,
+                args.spout_format,
+            )
+        )
         sd_thread.start()
 
-        # Keep main thread alive for Ctrl+C handling
-        while True:
-            time.sleep(1)
+        # Keep main thread alive until shutdown. On Windows an untimed
+        # Event.wait() cannot be interrupted by Ctrl+C, so wait in slices there
+        wait_timeout = 1 if os.name == 'nt' else None
+        while not config.exit_flag.wait(timeout=wait_timeout):
+            pass
 
     except KeyboardInterrupt:
         if config.verbose >= 1:
             print("\nShutting down...")
         config.exit_flag.set()
+        config.wakeup_event.set()
 
         # Wait for threads to finish
         osc_thread.join()
-        sd_thread.join()
+        if sd_thread is not None:
+            sd_thread.join()
 
         if config.verbose >= 1:
             print("Shutdown complete")
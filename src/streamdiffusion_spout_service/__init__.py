@@ -3,3 +3,22 @@ StreamDiffusion Spout Service package
 """
 
 __version__ = "0.1.0"
+
+# Public names resolved on first access, so importing the package (e.g. for
+# config) does not pull in torch/diffusers/SpoutGL
+_LAZY_ATTRS = {
+    "setup_stream_diffusion": ".diffusion_engine",
+    "start_diffusion_thread": ".diffusion_engine",
+    "start_osc_server": ".osc_server",
+    "SpoutReceiver": ".spout_handler",
+    "SpoutSender": ".spout_handler",
+    "ThreadedSpoutSender": ".spout_handler",
+}
+
+def __getattr__(name):
+    """Lazily import public names from their submodules"""
+    if name in _LAZY_ATTRS:
+        import importlib
+        module = importlib.import_module(_LAZY_ATTRS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
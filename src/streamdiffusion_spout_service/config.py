@@ -22,6 +22,8 @@ start_event = threading.Event()
 stop_event = threading.Event()
 spout_send_event = threading.Event()
 spout_restart_event = threading.Event()
+# Set alongside any of the above so the idle diffusion loop wakes up promptly
+wakeup_event = threading.Event()
 
 # Default prompt settings
 current_prompt = "abstract shape"
@@ -2,35 +2,32 @@
 StreamDiffusion engine for image processing - Fixed for Spout Buffer Mode and PIL Image Handling
 """
 import time
-import numpy as np
 from typing import Dict, Optional, Literal
 import queue
-import PIL
+import hashlib
+import functools
+import threading
 import warnings
-import torch
-import torchvision.transforms as T
+from collections import OrderedDict
 
 # Filter out specific warnings
 warnings.filterwarnings("ignore", message="Passing `image` as torch tensor with value range in")
 
-from utils.wrapper import StreamDiffusionWrapper
-
 from . import config
-from .utils import numpy_to_pil
-from .spout_handler import SpoutReceiver, SpoutSender
 
-import SpoutGL
+# Heavy dependencies (torch, StreamDiffusion, SpoutGL) are imported inside the
+# functions that use them, so importing this module does not delay the OSC server
 
-# Define image transformation for preprocessing
-transform = T.Compose([
-    T.ToTensor(),  # Convert PIL Image to tensor
-])
+# Denoising timestep indices into the num_inference_steps schedule
+T_INDEX_LIST = [22, 32, 45]
 
 def setup_stream_diffusion(
     model_id_or_path: str,
     lora_dict: Optional[Dict[str, float]] = None,
     width: int = 512,
     height: int = 512,
+    frame_buffer_size: int = 1,
+    warmup: int = 2,
     acceleration: Literal["none", "xformers", "tensorrt"] = "xformers",
     use_denoising_batch: bool = True,
     guidance_scale: float = 1.2,
@@ -45,6 +42,8 @@ def setup_stream_diffusion(
         lora_dict: Dictionary mapping LoRA names to scales
         width: Image width
         height: Image height
+        frame_buffer_size: Number of frames batched through each denoising call
+        warmup: Number of wrapper warmup iterations
         acceleration: Acceleration method
         use_denoising_batch: Whether to use denoising batch
         guidance_scale: Guidance scale
@@ -54,30 +53,163 @@ def setup_stream_diffusion(
     Returns:
         Initialized StreamDiffusionWrapper
     """
+    import torch
+    from utils.wrapper import StreamDiffusionWrapper
+
     if guidance_scale <= 1.0:
         cfg_type = "none"
 
     stream = StreamDiffusionWrapper(
         model_id_or_path=model_id_or_path,
         lora_dict=lora_dict,
-        t_index_list=[22, 32, 45],
-        frame_buffer_size=1,
+        t_index_list=T_INDEX_LIST,
+        frame_buffer_size=frame_buffer_size,
         width=width,
         height=height,
-        warmup=10,
+        warmup=warmup,
         acceleration=acceleration,
         mode="img2img",
         use_denoising_batch=use_denoising_batch,
         cfg_type=cfg_type,
         seed=seed,
+        dtype=torch.float16,
     )
 
+    # NHWC layout lets the FP16 conv kernels use tensor cores more efficiently
+    # (TensorRT engines manage their own layout)
+    if acceleration != "tensorrt":
+        stream.stream.unet.to(memory_format=torch.channels_last)
+        stream.stream.vae.to(memory_format=torch.channels_last)
+
     return stream
 
+def frame_to_tensor(frame, dtype, bgr=False, size=None):
+    """
+    Convert a received frame to model input on the GPU without going through PIL.
+    
+    Args:
+        frame: uint8 tensor of shape (H, W, 3) or (H, W, 4) on the device,
+            as returned by SpoutReceiver.receive_frame_tensor
+        dtype: Target torch dtype
+        bgr: Frame is in BGR(A) channel order
+        size: Optional (height, width) the frame is resized to on the GPU
+        
+    Returns:
+        Tensor of shape (1, 3, H, W) with values in [0, 1], H and W taken
+        from size if set
+    """
+    import torch.nn.functional as F
+
+    # Alpha (if any) is dropped and BGR reordered on the GPU rather than with
+    # a strided CPU copy
+    rgb = frame[:, :, [2, 1, 0]] if bgr else frame[:, :, :3]
+    image = rgb.permute(2, 0, 1).unsqueeze(0).to(dtype).div_(255.0)
+
+    # A Spout sender of another size is scaled to the model resolution
+    if size is not None and tuple(image.shape[-2:]) != tuple(size):
+        image = F.interpolate(image, size=size, mode="bilinear", antialias=True)
+
+    return image
+
+class FrameDownloader:
+    """Class for converting model output to 8-bit RGBA frames on the GPU and downloading them"""
+
+    def __init__(self, num_buffers=3, bgr=False):
+        """
+        Initialize the frame downloader.
+        
+        Args:
+            num_buffers: Number of pinned host buffers to rotate through
+            bgr: Emit BGRA channel order instead of RGBA
+        """
+        self.num_buffers = num_buffers
+        self.bgr = bgr
+
+        # GPU output buffer (alpha filled once) and pinned host buffers,
+        # allocated once the output size is known
+        self.gpu_buffer = None
+        self.buffers = []
+        self.index = 0
+
+        # Frames of each host buffer not yet released by the sender; a buffer
+        # is only overwritten once all of its frames were sent or dropped
+        self.in_use = []
+        self.released = threading.Condition()
+
+    def _release(self, in_use, slot):
+        """
+        Mark one frame of a host buffer as no longer used.
+        
+        Args:
+            in_use: Use counts of the buffer allocation the frame came from
+            slot: Index of the host buffer
+        """
+        with self.released:
+            in_use[slot] -= 1
+            self.released.notify_all()
+
+    def download(self, images):
+        """
+        Convert decoded images to uint8 RGBA frames and copy them to the host.
+        
+        Args:
+            images: Tensor of shape (N, 3, H, W) with values in [-1, 1]
+            
+        Returns:
+            Tuple of a list of N uint8 NumPy arrays of shape (H, W, 4), in
+            BGRA order if bgr is set, and a release callback to call once per
+            frame when it is no longer used. The arrays view a host buffer
+            that is not reused before all of them are released
+        """
+        import torch
+
+        n, _, height, width = images.shape
+        shape = (n, height, width, 4)
+        if self.gpu_buffer is None or tuple(self.gpu_buffer.shape) != shape:
+            self.gpu_buffer = torch.empty(shape, dtype=torch.uint8, device=images.device)
+            self.gpu_buffer[..., 3] = 255
+            self.buffers = [
+                torch.empty(shape, dtype=torch.uint8, pin_memory=True)
+                for _ in range(self.num_buffers)
+            ]
+            self.index = 0
+            # Frames of the previous buffers release into the old counts
+            self.in_use = [0] * self.num_buffers
+
+        # Denormalize, quantize and reorder to NHWC (and BGR) on the GPU, so
+        # only 8-bit pixels cross PCIe and no float conversion happens on the CPU
+        if self.bgr:
+            images = images[:, [2, 1, 0]]
+        pixels = images.permute(0, 2, 3, 1).mul(127.5).add_(127.5).clamp_(0, 255).round_()
+        self.gpu_buffer[..., :3] = pixels
+
+        slot = self.index
+        self.index = (self.index + 1) % self.num_buffers
+        in_use = self.in_use
+
+        # Wait until the sender is done with every frame from this buffer,
+        # e.g. if sendImage stalled for several iterations
+        with self.released:
+            self.released.wait_for(lambda: in_use[slot] == 0)
+            in_use[slot] = n
+
+        host = self.buffers[slot]
+        host.copy_(self.gpu_buffer)
+
+        release = functools.partial(self._release, in_use, slot)
+        return [frame.numpy() for frame in host], release
+
 # Initialize the prompt cache - store as global variable
-prompt_cache = {}
+# Ordered by recency of use, so the least recently used prompt is evicted first
+prompt_cache = OrderedDict()
+PROMPT_CACHE_SIZE = 32
+
+# Final prompt_embeds (repeated to batch size and CFG-concatenated), keyed like
+# prompt_cache and only valid for the stream settings they were built with
+prompt_embeds_cache = {}
+prompt_embeds_settings = None
 
-def update_prompt_without_reset(stream, new_prompt, new_negative_prompt, delta, guidance_scale=None):
+def update_prompt_without_reset(stream, new_prompt, new_negative_prompt, guidance_scale=None):
     """
     Updates the prompt without full model reset to avoid brown frames
     Includes efficient prompt caching to avoid redundant processing
@@ -86,17 +218,31 @@ def update_prompt_without_reset(stream, new_prompt, new_negative_prompt, delta,
         stream: The StreamDiffusion instance
         new_prompt: The new prompt to use
         new_negative_prompt: The new negative prompt to use
-        delta: The delta noise scale factor
         guidance_scale: Optional override for guidance scale (uses stream's value if None)
     """
-    global prompt_cache
+    import torch
+
+    global prompt_cache, prompt_embeds_settings
+    
+    # Update guidance scale if provided
+    if guidance_scale is not None:
+        stream.guidance_scale = guidance_scale
+
+    # Built embeddings depend on these settings, drop them if any changed
+    settings = (stream.batch_size, stream.guidance_scale, stream.cfg_type, stream.dtype)
+    if settings != prompt_embeds_settings:
+        prompt_embeds_cache.clear()
+        prompt_embeds_settings = settings
     
-    # Create cache key from prompt and negative prompt
-    cache_key = f"{new_prompt}||{new_negative_prompt}"
+    # Create cache key from a hash of prompt and negative prompt
+    cache_key = hashlib.blake2b(
+        f"{new_prompt}||{new_negative_prompt}".encode(), digest_size=16
+    ).digest()
     
     # Check if prompt is already cached
     if cache_key in prompt_cache:
         encoder_output = prompt_cache[cache_key]
+        prompt_cache.move_to_end(cache_key)
         if config.verbose >= 3:
             print(f"Using cached prompt: {new_prompt}")
     else:
@@ -113,30 +259,29 @@ def update_prompt_without_reset(stream, new_prompt, new_negative_prompt, delta,
         # Cache the result for future use
         prompt_cache[cache_key] = encoder_output
         
-        # Limit cache size to prevent memory issues (keep last 10 prompts)
-        if len(prompt_cache) > 10:
-            oldest_key = next(iter(prompt_cache))
-            prompt_cache.pop(oldest_key)
+        # Limit cache size to prevent memory issues (evict least recently used)
+        if len(prompt_cache) > PROMPT_CACHE_SIZE:
+            evicted_key, _ = prompt_cache.popitem(last=False)
+            prompt_embeds_cache.pop(evicted_key, None)
     
+    if cache_key not in prompt_embeds_cache:
+        prompt_embeds = encoder_output[0].to(dtype=stream.dtype).repeat(stream.batch_size, 1, 1)
+
+        # If guidance scale is > 1.0, handle the classifier-free guidance
+        if stream.guidance_scale > 1.0 and (
+            stream.cfg_type == "initialize" or stream.cfg_type == "full"
+        ):
+            if encoder_output[1] is not None:  # Check if uncond_embeddings exists
+                uncond_embeddings = encoder_output[1].to(dtype=stream.dtype).repeat(stream.batch_size, 1, 1)
+                prompt_embeds = torch.cat([uncond_embeddings, prompt_embeds], dim=0)
+
+        prompt_embeds_cache[cache_key] = prompt_embeds
+
     # Update only the prompt embeddings, not the entire model state
-    stream.prompt_embeds = encoder_output[0].repeat(stream.batch_size, 1, 1)
-    
-    # Update guidance scale if provided
-    if guidance_scale is not None:
-        stream.guidance_scale = guidance_scale
+    stream.prompt_embeds = prompt_embeds_cache[cache_key]
     
-    # If guidance scale is > 1.0, handle the classifier-free guidance
-    if stream.guidance_scale > 1.0 and (
-        stream.cfg_type == "initialize" or stream.cfg_type == "full"
-    ):
-        if encoder_output[1] is not None:  # Check if uncond_embeddings exists
-            uncond_embeddings = encoder_output[1].repeat(stream.batch_size, 1, 1)
-            stream.prompt_embeds = torch.cat([uncond_embeddings, stream.prompt_embeds], dim=0)
-    
-    # Scale the noise with delta but preserve the noise pattern
-    stream.stock_noise *= delta
-    
-    # No timestep updates or other pipeline resets
+    # No noise, timestep updates or other pipeline resets (delta is applied
+    # once by stream.prepare)
 
 def start_diffusion_thread(
     model_id,
@@ -147,6 +292,11 @@ def start_diffusion_thread(
     spout_sender_name,
     acceleration,
     delta,
+    compile_mode="reduce-overhead",
+    frame_buffer_size=1,
+    warmup=2,
+    num_inference_steps=50,
+    spout_format="rgba",
 ):
     """
     Thread function for diffusion processing.
@@ -160,7 +310,15 @@ def start_diffusion_thread(
         spout_sender_name: Spout sender name
         acceleration: Acceleration method
         delta: Delta multiplier of virtual residual noise
+        compile_mode: torch.compile mode for the UNet ("none" to disable)
+        frame_buffer_size: Number of frames batched through each denoising call
+        warmup: Number of wrapper warmup iterations
+        num_inference_steps: Length of the timestep schedule T_INDEX_LIST indexes into
+        spout_format: Spout pixel format ("rgba" or "bgra")
     """
+    import torch
+    from .spout_handler import PIXEL_FORMATS, SpoutReceiver, ThreadedSpoutSender
+
     # Initialize StreamDiffusion
     if config.verbose >= 1:
         print(f"Initializing StreamDiffusion with model: {model_id}")
@@ -169,16 +327,31 @@ def start_diffusion_thread(
         lora_dict=lora_dict,
         width=width,
         height=height,
+        frame_buffer_size=frame_buffer_size,
+        warmup=warmup,
         acceleration=acceleration,
     )
 
+    # Compile the UNet (TensorRT engines are already specialized)
+    if compile_mode != "none" and acceleration != "tensorrt":
+        if config.verbose >= 1:
+            print(f"Compiling UNet with torch.compile (mode: {compile_mode})")
+        stream.stream.unet = torch.compile(stream.stream.unet, mode=compile_mode, fullgraph=False)
+
+    # The schedule must be long enough for every index in T_INDEX_LIST
+    min_steps = max(T_INDEX_LIST) + 1
+    if num_inference_steps < min_steps:
+        if config.verbose >= 1:
+            print(f"num_inference_steps {num_inference_steps} too small for t_index_list, using {min_steps}")
+        num_inference_steps = min_steps
+
     # Initialize with default prompt
     if config.verbose >= 1:
         print(f"Preparing StreamDiffusion with prompt: '{config.current_prompt}'")
     stream.prepare(
         prompt=config.current_prompt,
         negative_prompt=config.current_negative_prompt,
-        num_inference_steps=50,
+        num_inference_steps=num_inference_steps,
         guidance_scale=1.2,
         delta=delta,
     )
@@ -187,23 +360,35 @@ def start_diffusion_thread(
     
 
     # Initialize Spout
-    receiver = SpoutReceiver(spout_receiver_name, width, height)
-    sender = SpoutSender(spout_sender_name, width, height)
+    # Frames are received straight into pinned memory, so they are uploaded
+    # without an extra staging copy
+    receiver = SpoutReceiver(
+        spout_receiver_name, width, height, pin_memory=True, pixel_format=spout_format
+    )
+    # Frames are sent from a worker thread so the next frame's UNet can start
+    sender = ThreadedSpoutSender(spout_sender_name, width, height, spout_format)
 
-    # Create a black image for warmup
+    # Create a black input batch for warmup, built once and reused
     if config.verbose >= 1:
         print("Warming up StreamDiffusion...")
-    black_image = np.zeros((height, width, 3), dtype=np.uint8)
-    black_pil = PIL.Image.fromarray(black_image)
-
-    # Warmup with a proper black image
-    for _ in range(stream.batch_size - 1):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            stream.preprocess_image(black_pil)  # Just to initialize
+    black_tensor = torch.zeros(
+        (frame_buffer_size, 3, height, width), dtype=stream.dtype, device=stream.device
+    )
 
-    for _ in range(5):
-        stream.preprocess_image(black_pil)  # Just to initialize
+    # Fill the denoising batch, then run extra frames so the (compiled) UNet
+    # is traced before the first real frame
+    try:
+        for _ in range(stream.batch_size + 4):
+            stream.stream(black_tensor)
+    except Exception as e:
+        # torch.compile fails lazily on the first call, e.g. when Triton is
+        # unavailable (Windows), so fall back to the eager UNet
+        if not hasattr(stream.stream.unet, "_orig_mod"):
+            raise
+        print(f"torch.compile failed, continuing without it: {e}")
+        stream.stream.unet = stream.stream.unet._orig_mod
+        for _ in range(stream.batch_size + 4):
+            stream.stream(black_tensor)
 
     if config.verbose >= 1:
         print("--------------------")
@@ -217,71 +402,108 @@ def start_diffusion_thread(
     wait_frames = 0
     config.spout_send_event.set()
 
+    # Uploaded frames waiting to fill a batch of frame_buffer_size
+    _, bgr = PIXEL_FORMATS[spout_format]
+    downloader = FrameDownloader(bgr=bgr)
+    pending_frames = []
+
     while not config.exit_flag.is_set():
+        # Read the verbose level once per iteration
+        verbose = config.verbose
+
         # Check if Spout restart is requested
         if config.spout_restart_event.is_set():
-            if config.verbose >= 1:
+            if verbose >= 1:
                 print("Restarting Spout connections...")
 
+            # Frames from before the restart are not batched with new ones
+            pending_frames.clear()
+
             try:
                 receiver.restart()
                 sender.restart()
                 config.spout_restart_event.clear()
 
-                if config.verbose >= 1:
+                if verbose >= 1:
                     print("Spout connections restarted")
 
             except Exception as e:
-                if config.verbose >= 1:
+                if verbose >= 1:
                     print(f"Spout restart failed: {e}")
                 config.spout_restart_event.clear()
         
-        # Check if we need to update the prompt
-        try:
-            new_prompt, new_negative_prompt = config.prompt_queue.get_nowait()
-
-            if config.verbose >= 2:
-                print(f"Updating prompt: {new_prompt[:40]}...")
+        # Drain the prompt queue, only the most recent prompt is applied
+        latest_prompt = None
+        while True:
+            try:
+                latest_prompt = config.prompt_queue.get_nowait()
+                config.prompt_queue.task_done()
+            except queue.Empty:
+                break
 
-            # Use the optimized update method with cache
-            update_prompt_without_reset(stream.stream, new_prompt, new_negative_prompt, delta)
+        if latest_prompt is not None:
+            new_prompt, new_negative_prompt = latest_prompt
+            try:
+                if verbose >= 2:
+                    print(f"Updating prompt: {new_prompt[:40]}...")
 
-            config.prompt_queue.task_done()
+                # Use the optimized update method with cache
+                update_prompt_without_reset(stream.stream, new_prompt, new_negative_prompt)
 
-        except queue.Empty:
-            pass
-        except Exception as e:
-            print(f"Error updating prompt: {e}")
-            if not config.prompt_queue.empty():
-                config.prompt_queue.task_done()
+            except Exception as e:
+                print(f"Error updating prompt: {e}")
         
         if config.stop_event.is_set():
             config.stop_event.clear()
             config.start_event.clear()
+            pending_frames.clear()
 
         # Check if we should process an image
         if config.trigger_event.is_set() or config.start_event.is_set():
             # Try to receive a frame
-            input_image = receiver.receive_frame()
+            input_frame = receiver.receive_frame_tensor(stream.device)
 
-            if input_image is not None:
+            if input_frame is not None:
                 frame_count += 1
 
                 # Print status about received frame
-                if config.verbose >= 3:
+                if verbose >= 3:
                     print(f"Processing frame #{frame_count}")
 
                 if config.spout_send_event.is_set():
-                    output_image = stream(stream.preprocess_image(input_image))
-                    sender.send_frame(output_image)
+                    pending_frames.append(
+                        frame_to_tensor(input_frame, stream.dtype, bgr, (height, width))
+                    )
+
+                    if len(pending_frames) == frame_buffer_size:
+                        if frame_buffer_size == 1:
+                            input_tensor = pending_frames[0]
+                        else:
+                            input_tensor = torch.cat(pending_frames)
+                        pending_frames.clear()
+
+                        # Call the pipeline directly so its output stays on the
+                        # GPU, instead of the wrapper's float PIL postprocessing
+                        output_tensor = stream.stream(input_tensor)
+                        output_frames, release = downloader.download(output_tensor)
+                        for output_frame in output_frames:
+                            sender.send_frame_numpy(output_frame, release)
+                else:
+                    # Output paused, drop any partial batch
+                    pending_frames.clear()
 
             else:
-                if config.verbose >= 3:
+                if verbose >= 3:
                     print("Trigger received but no input image available")
             
             # Reset trigger
             config.trigger_event.clear()
 
+        # Idle until an OSC command arrives, unless generating continuously
+        if not config.start_event.is_set():
+            config.wakeup_event.wait(timeout=0.1)
+            config.wakeup_event.clear()
+
     # Cleanup
     receiver.close()
     sender.close()
@@ -1,7 +1,7 @@
 """
 OSC server implementation for receiving commands
 """
-import socket
+import threading
 from pythonosc.dispatcher import Dispatcher
 from pythonosc.osc_server import BlockingOSCUDPServer
 
@@ -28,6 +28,7 @@ def process_set_prompt(address, *args):
 
     # Put the new prompt in the queue
     config.prompt_queue.put((config.current_prompt, config.current_negative_prompt))
+    config.wakeup_event.set()
 
 def process_trigger(address, *args):
     """
@@ -40,6 +41,7 @@ def process_trigger(address, *args):
     if config.verbose >= 2:
         print("Generation triggered")
     config.trigger_event.set()
+    config.wakeup_event.set()
 
 def process_continuous_start(address, *args):
     """
@@ -53,6 +55,7 @@ def process_continuous_start(address, *args):
     if not config.start_event.is_set() and config.verbose >= 2:
         print("Continuous started")
     config.start_event.set()
+    config.wakeup_event.set()
 
 def process_continuous_stop(address, *args):
     """
@@ -66,6 +69,7 @@ def process_continuous_stop(address, *args):
     if config.start_event.is_set() and config.verbose >= 2:
         print("Continuous stopped")
     config.stop_event.set()
+    config.wakeup_event.set()
 
 def process_spout_start(address, *args):
     """
@@ -79,6 +83,7 @@ def process_spout_start(address, *args):
     if not config.spout_send_event.is_set() and config.verbose >= 2:
         print("Spout started")
     config.spout_send_event.set()
+    config.wakeup_event.set()
 
 def process_spout_stop(address, *args):
     """
@@ -92,6 +97,7 @@ def process_spout_stop(address, *args):
     if config.spout_send_event.is_set() and config.verbose >= 2:
         print("Spout stopped")
     config.spout_send_event.clear()
+    config.wakeup_event.set()
 
 def process_verbose_set(address, *args):
     """
@@ -155,6 +161,7 @@ def process_spout_restart(address, *args):
     if config.verbose >= 1:
         print("Spout restart requested")
     config.spout_restart_event.set()
+    config.wakeup_event.set()
 
 
 def start_osc_server(ip, port):
@@ -182,9 +189,12 @@ def start_osc_server(ip, port):
     dispatcher.map("/x", process_spout_restart)        
    
     server = BlockingOSCUDPServer((ip, port), dispatcher)
-    
-    # Set a timeout on the server socket
-    server.socket.settimeout(0.5)  # Check exit flag every 0.5 seconds
+
+    # Serve from a helper thread; shutdown() stops it once the exit flag is set
+    # The 0.5 s poll interval keeps idle wakeups low, at the cost of up to
+    # 0.5 s for shutdown() to return (messages are still handled immediately)
+    serve_thread = threading.Thread(target=server.serve_forever, args=(0.5,), daemon=True)
+    serve_thread.start()
     
     if config.verbose >= 1:
         print("--------------------")
@@ -192,12 +202,8 @@ def start_osc_server(ip, port):
         print("--------------------")
    
     # Keep running until exit flag is set
-    while not config.exit_flag.is_set():
-        try:
-            server.handle_request()
-        except socket.timeout:
-            # This is expected - just allows us to check the flag
-            pass
-        except Exception as e:
-            print(f"Error in OSC server: {e}")
-            break
\ No newline at end of file
+    config.exit_flag.wait()
+
+    server.shutdown()
+    server.server_close()
+    serve_thread.join()
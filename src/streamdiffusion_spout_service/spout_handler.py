@@ -3,14 +3,44 @@ Spout sender and receiver classes for image sharing
 """
 import numpy as np
 import SpoutGL
-import array
+import queue
+import threading
 from OpenGL import GL
 from PIL import Image
 
+from . import config
+from .utils import rgb_to_rgba
+
+# Pixel formats for Spout transfers: OpenGL format and whether red and blue
+# are swapped (BGR order)
+# "bgra" matches the texture layout most Windows GL drivers use internally,
+# which can spare the driver a swizzle on every transfer
+PIXEL_FORMATS = {
+    "rgba": (GL.GL_RGBA, False),
+    "bgra": (GL.GL_BGRA, True),
+}
+
+def _image_to_frame(image, pixel_format):
+    """
+    Convert a PIL Image to a NumPy frame as accepted by send_frame_numpy.
+
+    Args:
+        image: PIL Image (RGB or RGBA)
+        pixel_format: Sender pixel format, a key of PIXEL_FORMATS
+
+    Returns:
+        uint8 array; RGBA images are reordered to BGRA for BGR formats
+    """
+    frame = np.asarray(image)
+    if PIXEL_FORMATS[pixel_format][1] and image.mode == 'RGBA':
+        # NumPy RGBA-sized frames are taken as BGRA
+        frame = frame[:, :, [2, 1, 0, 3]]
+    return frame
+
 class SpoutReceiver:
     """Class for receiving images via Spout"""
 
-    def __init__(self, name, width, height):
+    def __init__(self, name, width, height, num_buffers=3, pin_memory=False, pixel_format="rgba"):
         """
         Initialize Spout receiver.
 
@@ -18,76 +48,183 @@ class SpoutReceiver:
             name: Spout receiver name
             width: Initial image width
             height: Initial image height
+            num_buffers: Number of receive buffers to rotate through
+            pin_memory: Allocate receive buffers in CUDA pinned memory (requires
+                torch), so receive_frame_tensor uploads them without staging
+            pixel_format: Format frames are received in, a key of PIXEL_FORMATS
         """
         self.name = name
         self.width = width
         self.height = height
+        self.num_buffers = num_buffers
+        self.pin_memory = pin_memory
+        self.gl_format, self.bgr = PIXEL_FORMATS[pixel_format]
 
         # Initialize Spout receiver
         self.receiver = SpoutGL.SpoutReceiver()
         success = self.receiver.setReceiverName(name)
 
-        from . import config
         if not success and config.verbose >= 2:
             print(f"Note: Spout receiver name not pre-set (will auto-detect sender)")
 
-        # Initialize the buffer for image receiving
-        # Buffer will be recreated when sender dimensions are updated
-        self.buffer = None
+        # Initialize the ring of buffers for image receiving, so a returned
+        # frame stays valid until num_buffers - 1 further frames are received
+        # Buffers will be recreated when sender dimensions are updated
+        self.buffers = []
+        self.buffer_index = 0
+        # Most recently received frame, returned again while the sender has
+        # not published a new one
+        self.last_frame = None
+        # CUDA events marking when each pinned buffer's last upload completed
+        self.upload_events = []
 
         if config.verbose >= 2:
             print(f"Spout receiver ready for '{name}'")
+
+    def _allocate_buffers(self, buffer_size):
+        """
+        Allocate the ring of (uninitialized) receive buffers.
+
+        Args:
+            buffer_size: Size of each buffer in bytes
+        """
+        if self.pin_memory:
+            import torch
+            # NumPy views over page-locked memory, SpoutGL writes via the buffer protocol
+            self.buffers = [
+                torch.empty(buffer_size, dtype=torch.uint8, pin_memory=True).numpy()
+                for _ in range(self.num_buffers)
+            ]
+            self.upload_events = [torch.cuda.Event() for _ in range(self.num_buffers)]
+        else:
+            self.buffers = [np.empty(buffer_size, dtype=np.uint8) for _ in range(self.num_buffers)]
+            self.upload_events = []
+        self.buffer_index = 0
+        self.last_frame = None
         
+    def receive_frame_array(self):
+        """
+        Receive a frame from Spout as a NumPy array.
+
+        Returns:
+            uint8 array of shape (H, W, 4) in the pixel format's channel order,
+            viewing a receive buffer (valid until the ring wraps around to
+            it). While the sender has not published a new frame, the last
+            received frame is returned again; None if nothing was received
+        """
+        receiver = self.receiver
+
+        # A pinned buffer may still be uploading from its previous use
+        if self.upload_events:
+            self.upload_events[self.buffer_index].synchronize()
+
+        # Receive image into the next buffer of the ring
+        buffer = self.buffers[self.buffer_index] if self.buffers else None
+        if not receiver.receiveImage(buffer, self.gl_format, False, 0):
+            return None
+
+        # Sender connected or changed (rare): adopt its size and receive again
+        if receiver.isUpdated():
+            buffer = self._handle_resize()
+            if not receiver.receiveImage(buffer, self.gl_format, False, 0):
+                return None
+
+        # receiveImage returns False when nothing was received, so the pixels
+        # themselves are not scanned for emptiness. A still or paused sender
+        # repeats its last frame; the current slot was not written then
+        if not receiver.isFrameNew():
+            return self.last_frame
+
+        self.buffer_index = (self.buffer_index + 1) % len(self.buffers)
+        self.last_frame = buffer.reshape(self.height, self.width, 4)
+        return self.last_frame
+
+    def _handle_resize(self):
+        """
+        Adopt the sender's dimensions after an update.
+
+        Returns:
+            Buffer to receive the current frame into
+        """
+        self.width = self.receiver.getSenderWidth()
+        self.height = self.receiver.getSenderHeight()
+
+        # Create new (uninitialized) buffers only if the size changed;
+        # updates also fire when a sender reconnects at the same size
+        buffer_size = self.width * self.height * 4
+        if not self.buffers or self.buffers[0].size != buffer_size:
+            self._allocate_buffers(buffer_size)
+
+        if config.verbose >= 2:
+            print(f"Spout input detected: {self.width}x{self.height}")
+
+        return self.buffers[self.buffer_index]
+
+    def receive_frame_tensor(self, device):
+        """
+        Receive a frame from Spout and upload it to the GPU.
+
+        With pinned memory the copy is queued on the current CUDA stream
+        without blocking; the buffer is not reused until the copy has completed.
+
+        Args:
+            device: Target torch device
+
+        Returns:
+            uint8 tensor of shape (H, W, 4) on the device (the last frame again
+            if the sender has not published a new one), or None if nothing
+            was received
+        """
+        import torch
+
+        frame = self.receive_frame_array()
+        if frame is None:
+            return None
+
+        gpu_frame = torch.from_numpy(frame).to(device, non_blocking=self.pin_memory)
+        if self.upload_events:
+            # The returned frame is always in the slot before buffer_index
+            self.upload_events[self.buffer_index - 1].record()
+
+        return gpu_frame
+
     def receive_frame(self):
         """
         Receive a frame from Spout.
 
         Returns:
-            PIL Image containing the image, or None if no new frame
-        """
-        # Receive image into buffer
-        result = self.receiver.receiveImage(self.buffer, GL.GL_RGBA, False, 0)
-
-        # Check if sender dimensions have been updated
-        if self.receiver.isUpdated() and self.receiver.isFrameNew():
-            self.width = self.receiver.getSenderWidth()
-            self.height = self.receiver.getSenderHeight()
-            # Create a new buffer with the updated dimensions
-            buffer_size = self.width * self.height * 4
-            self.buffer = array.array('B', bytes(buffer_size))
-            from . import config
-            if config.verbose >= 2:
-                print(f"Spout input detected: {self.width}x{self.height}")
-
-            # First time we detect a sender, we need to get the image again
-            if result:
-                result = self.receiver.receiveImage(self.buffer, GL.GL_RGBA, False, 0)
-
-        # If we have a valid buffer and received something
-        if self.buffer and result and not SpoutGL.helpers.isBufferEmpty(self.buffer):
-            image = Image.frombuffer('RGBA', (self.width, self.height), self.buffer, 'raw', 'RGBA', 0, 1)
-            return image
-
-        return None
+            PIL Image containing the image (the last frame again if the sender
+            has not published a new one), or None if nothing was received
+        """
+        frame = self.receive_frame_array()
+        if frame is None:
+            return None
+
+        if self.bgr:
+            # Reordered to RGBA by PIL while copying
+            return Image.frombuffer('RGBA', (self.width, self.height), frame, 'raw', 'BGRA', 0, 1)
+
+        # Wraps the receive buffer without copying
+        return Image.fromarray(frame, 'RGBA')
         
     def restart(self):
         """Restart the Spout receiver connection"""
-        from . import config
         if config.verbose >= 1:
             print(f"SpoutReceiver restarting...", end='')
 
-        # Release existing receiver
-        self.receiver.releaseReceiver()
-
-        # Reinitialize receiver
-        self.receiver = SpoutGL.SpoutReceiver()
-        success = self.receiver.setReceiverName(self.name)
+        # Release and reconnect the existing receiver, keeping its GL state
+        try:
+            self.receiver.releaseReceiver()
+            success = self.receiver.setReceiverName(self.name)
+        except Exception:
+            # Only create a new receiver if the existing one is unusable
+            self.receiver = SpoutGL.SpoutReceiver()
+            success = self.receiver.setReceiverName(self.name)
         if not success:
             if config.verbose >= 1:
                 print(f"Warning: Could not set receiver name to '{self.name}'")
 
-        # Reset buffer
-        self.buffer = None
+        # Buffers are kept, they are reallocated only if the sender size changes
 
         if config.verbose >= 1:
             print("[OK]")
@@ -96,7 +233,6 @@ class SpoutReceiver:
 
     def close(self):
         """Clean up resources"""
-        from . import config
         if config.verbose >= 1:
             print(f"SpoutReceiver closing...", end='')
         self.receiver.releaseReceiver()
@@ -107,7 +243,7 @@ class SpoutReceiver:
 class SpoutSender:
     """Class for sending images via Spout"""
 
-    def __init__(self, name, width, height):
+    def __init__(self, name, width, height, pixel_format="rgba"):
         """
         Initialize Spout sender.
 
@@ -115,18 +251,39 @@ class SpoutSender:
             name: Spout sender name
             width: Image width
             height: Image height
+            pixel_format: Format frames are sent in, a key of PIXEL_FORMATS
         """
         self.name = name
         self.width = width
         self.height = height
+        self.pixel_format = pixel_format
+        self.gl_format, self.bgr = PIXEL_FORMATS[pixel_format]
 
         # Initialize Spout sender
         self.sender = SpoutGL.SpoutSender()
         self.sender.setSenderName(name)
 
-        from . import config
+        # Reusable RGBA scratch buffer for RGB frames
+        self._rgba_buf = None
+        self._resize(height, width)
+
         if config.verbose >= 2:
             print(f"Spout sender ready as '{name}'")
+
+    def _resize(self, height, width):
+        """
+        Reallocate the RGBA scratch buffer if the frame size changed.
+
+        Args:
+            height: Frame height
+            width: Frame width
+        """
+        if self._rgba_buf is not None and self._rgba_buf.shape[:2] == (height, width):
+            return
+
+        self._rgba_buf = np.empty((height, width, 4), dtype=np.uint8)
+        # Alpha is filled once, frames only overwrite the RGB channels
+        self._rgba_buf[:, :, 3] = 255
         
     def send_frame(self, image):
         """
@@ -138,44 +295,196 @@ class SpoutSender:
         Returns:
             True if successful, False otherwise
         """
-        if image.mode == 'RGBA':
-            # If already RGBA, just get the raw bytes
-            pixels = image.tobytes()
-        elif image.mode == 'RGB':
-            rgb_array = np.array(image)
-            # Create RGBA array with 255 alpha
-            rgba_array = np.ones((self.height, self.width, 4), dtype=np.uint8) * 255
-            # Copy RGB data
-            rgba_array[:, :, 0:3] = rgb_array
-            pixels = rgba_array.tobytes()
+        return self.send_frame_numpy(_image_to_frame(image, self.pixel_format))
 
-        width, height = image.size
+    def send_frame_numpy(self, arr):
+        """
+        Send a frame via Spout without going through PIL.
+
+        Args:
+            arr: uint8 NumPy array of shape (H, W, 3) with RGB pixels, or
+                (H, W, 4) in the pixel format's channel order (RGBA or BGRA)
 
-        result = self.sender.sendImage(pixels, width, height, GL.GL_RGBA, False, 0)
+        Returns:
+            True if successful, False otherwise
+        """
+        height, width, channels = arr.shape
+
+        if channels == 4:
+            # Already in the pixel format, pass the pixels as a flat byte view
+            if not arr.flags.c_contiguous:
+                arr = np.ascontiguousarray(arr)
+            pixels = memoryview(arr).cast('B')
+        else:
+            # Copy RGB data into the scratch buffer, alpha is already 255;
+            # a reversed view writes BGR without an extra pass
+            self._resize(height, width)
+            rgb_to_rgba(arr[:, :, ::-1] if self.bgr else arr, self._rgba_buf)
+            pixels = memoryview(self._rgba_buf).cast('B')
+
+        result = self.sender.sendImage(pixels, width, height, self.gl_format, False, 0)
 
         return result
     
     def restart(self):
         """Restart the Spout sender connection"""
-        from . import config
         if config.verbose >= 1:
             print(f"SpoutSender restarting...", end='')
 
-        # Release existing sender
-        self.sender.releaseSender()
-
-        # Reinitialize sender
-        self.sender = SpoutGL.SpoutSender()
-        self.sender.setSenderName(self.name)
+        # Release and rename the existing sender, keeping its GL state; the
+        # sender is recreated on the next send
+        try:
+            self.sender.releaseSender()
+            self.sender.setSenderName(self.name)
+        except Exception:
+            # Only create a new sender if the existing one is unusable
+            self.sender = SpoutGL.SpoutSender()
+            self.sender.setSenderName(self.name)
 
         if config.verbose >= 1:
             print("[OK]")
 
     def close(self):
         """Clean up resources"""
-        from . import config
         if config.verbose >= 1:
             print(f"SpoutSender [{self.name}] closing...", end='')
         self.sender.releaseSender()
         if config.verbose >= 1:
             print("[OK]")
+
+
+class ThreadedSpoutSender:
+    """Class for sending images via Spout from a dedicated worker thread"""
+
+    def __init__(self, name, width, height, pixel_format="rgba"):
+        """
+        Initialize the threaded Spout sender and start its worker thread.
+
+        Args:
+            name: Spout sender name
+            width: Image width
+            height: Image height
+            pixel_format: Format frames are sent in, a key of PIXEL_FORMATS
+        """
+        self.name = name
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+
+        # Single-slot handoff: a newer frame replaces one not yet sent
+        self.queue = queue.Queue(maxsize=1)
+        self.restart_event = threading.Event()
+        self.stop_event = threading.Event()
+
+        # Set by the worker once a requested restart was handled, with the
+        # error it raised (if any) so restart() can report it
+        self.restart_done = threading.Event()
+        self.restart_error = None
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """Worker loop; the SpoutSender (and its GL context) lives on this thread only"""
+        try:
+            sender = SpoutSender(self.name, self.width, self.height, self.pixel_format)
+        except Exception as e:
+            # Frames are dropped until a restart creates the sender
+            sender = None
+            if config.verbose >= 1:
+                print(f"Spout sender creation failed: {e}")
+
+        while not self.stop_event.is_set():
+            # None only wakes the worker up for restart/close
+            item = self.queue.get()
+            frame, release = item if item is not None else (None, None)
+
+            if self.restart_event.is_set():
+                self.restart_event.clear()
+                try:
+                    if sender is None:
+                        sender = SpoutSender(self.name, self.width, self.height, self.pixel_format)
+                    else:
+                        sender.restart()
+                    self.restart_error = None
+                except Exception as e:
+                    self.restart_error = e
+                self.restart_done.set()
+
+            if frame is not None and sender is not None:
+                try:
+                    sender.send_frame_numpy(frame)
+                except Exception as e:
+                    # Keep the worker alive, the next frame may succeed
+                    if config.verbose >= 1:
+                        print(f"Spout send failed: {e}")
+
+            if release is not None:
+                release()
+
+        if sender is not None:
+            sender.close()
+
+    def _wake(self):
+        """Wake the worker without waiting for a free slot"""
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def send_frame(self, image):
+        """
+        Hand a frame to the worker thread, replacing any frame not yet sent.
+
+        Args:
+            image: PIL Image to send (RGB or RGBA)
+        """
+        self.send_frame_numpy(_image_to_frame(image, self.pixel_format))
+
+    def send_frame_numpy(self, arr, release=None):
+        """
+        Hand a NumPy frame to the worker thread, replacing any frame not yet sent.
+
+        Args:
+            arr: uint8 NumPy array as accepted by SpoutSender.send_frame_numpy;
+                it must not be modified until the worker is done with it
+            release: Optional callback, called once the frame was sent or
+                dropped, after which its memory may be reused
+        """
+        while True:
+            try:
+                self.queue.put_nowait((arr, release))
+                return
+            except queue.Full:
+                try:
+                    dropped = self.queue.get_nowait()
+                except queue.Empty:
+                    continue
+                if dropped is not None and dropped[1] is not None:
+                    dropped[1]()
+
+    def restart(self, timeout=5.0):
+        """
+        Restart the Spout sender connection on the worker thread.
+
+        Args:
+            timeout: Seconds to wait for the worker to handle the restart
+
+        Raises:
+            Exception: The error raised by the restart, or RuntimeError if the
+                worker did not handle it in time
+        """
+        self.restart_done.clear()
+        self.restart_event.set()
+        self._wake()
+
+        if not self.restart_done.wait(timeout):
+            raise RuntimeError("Spout sender restart timed out")
+        if self.restart_error is not None:
+            raise self.restart_error
+
+    def close(self):
+        """Stop the worker thread and clean up resources"""
+        self.stop_event.set()
+        self._wake()
+        self.thread.join()
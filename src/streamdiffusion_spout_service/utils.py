@@ -1,25 +1,115 @@
 """
 Utility functions for the StreamDiffusion daemon
 """
+import re
 import numpy as np
 from PIL import Image
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 
-def numpy_to_pil(numpy_img: np.ndarray) -> Image.Image:
+def numpy_to_pil(numpy_img: np.ndarray, out: Optional[np.ndarray] = None) -> Image.Image:
     """
     Convert a numpy array to a PIL Image.
     
     Args:
         numpy_img: NumPy array representing an image
+        out: Optional preallocated uint8 array of the same shape to convert
+            into, avoiding a new allocation per call. The returned image may
+            share memory with it, so reuse it only once the image is consumed
         
     Returns:
-        PIL Image object
+        PIL Image object (sharing memory with a contiguous uint8 input)
     """
-    if numpy_img.shape[2] == 3:  # RGB
-        return Image.fromarray(numpy_img.astype(np.uint8))
-    else:  # RGBA
-        return Image.fromarray(numpy_img.astype(np.uint8), 'RGBA')
+    mode = 'RGBA' if numpy_img.shape[2] == 4 else 'RGB'
+
+    if out is not None:
+        np.copyto(out, numpy_img, casting='unsafe')
+        numpy_img = out
+    elif numpy_img.dtype != np.uint8 or not numpy_img.flags.c_contiguous:
+        # Only copy when the dtype or memory layout requires it
+        numpy_img = np.ascontiguousarray(numpy_img, dtype=np.uint8)
+
+    return Image.fromarray(numpy_img, mode)
+        
+# Numba kernel built on the first rgb_to_rgba call; False if numba is missing
+_rgb_to_rgba_kernel = None
+
+def _get_rgb_to_rgba_kernel():
+    """
+    Import numba and build the RGB->RGBA kernel once.
+    
+    Deferred so that importing this module (e.g. for parse_lora_string before
+    the OSC server starts) does not pay for the numba import.
+    
+    Returns:
+        Compiled kernel function, or False if numba is not installed
+    """
+    global _rgb_to_rgba_kernel
+    if _rgb_to_rgba_kernel is not None:
+        return _rgb_to_rgba_kernel
+
+    try:
+        import numba
+    except ImportError:  # Optional, NumPy is used instead
+        _rgb_to_rgba_kernel = False
+        return _rgb_to_rgba_kernel
+
+    @numba.njit(parallel=True, cache=True, boundscheck=False)
+    def _rgb_to_rgba_numba(rgb, rgba):
+        height, width, _ = rgb.shape
+        for y in numba.prange(height):
+            for x in range(width):
+                rgba[y, x, 0] = rgb[y, x, 0]
+                rgba[y, x, 1] = rgb[y, x, 1]
+                rgba[y, x, 2] = rgb[y, x, 2]
+                rgba[y, x, 3] = 255
+
+    _rgb_to_rgba_kernel = _rgb_to_rgba_numba
+    return _rgb_to_rgba_kernel
+
+def rgb_to_rgba(rgb: np.ndarray, rgba: np.ndarray) -> None:
+    """
+    Expand an RGB image into a preallocated RGBA buffer.
+    
+    Uses a parallel Numba kernel when numba is installed, otherwise a NumPy
+    copy into the RGB channels.
+    
+    Args:
+        rgb: uint8 array of shape (H, W, 3)
+        rgba: uint8 array of shape (H, W, 4) whose alpha channel is already 255
+    """
+    # The first call imports numba and JIT-compiles the kernel (or loads it
+    # from numba's cache) on the calling thread, i.e. the Spout sender thread
+    kernel = _get_rgb_to_rgba_kernel()
+    if kernel:
+        kernel(rgb, rgba)
+    else:
+        np.copyto(rgba[:, :, 0:3], rgb)
+        
+# One "name:scale" entry per match; entries without a colon are skipped
+_LORA_PAIR_RE = re.compile(r'\s*([^,:]*?)\s*:\s*([^,]*?)\s*(?:,|$)')
+
+@lru_cache(maxsize=128)
+def _parse_lora_pairs(lora_string: str) -> Tuple[Tuple[str, float], ...]:
+    """
+    Parse a LoRA string into (name, scale) pairs, memoized per string.
+    
+    Args:
+        lora_string: String in format "name1:scale1,name2:scale2"
         
+    Returns:
+        Immutable tuple of (name, scale) pairs, so callers cannot alter the cache
+    """
+    pairs = []
+    for match in _LORA_PAIR_RE.finditer(lora_string):
+        name, scale = match.groups()
+        try:
+            pairs.append((name, float(scale)))
+        except ValueError:
+            print(f"Warning: Invalid LoRA scale '{scale}' for '{name}', skipping")
+    
+    return tuple(pairs)
+
 def parse_lora_string(lora_string: str) -> Dict[str, float]:
     """
     Parse a LoRA string into a dictionary.
@@ -33,13 +123,4 @@ def parse_lora_string(lora_string: str) -> Dict[str, float]:
     if not lora_string:
         return None
         
-    lora_dict = {}
-    for pair in lora_string.split(','):
-        if ':' in pair:
-            name, scale = pair.split(':')
-            try:
-                lora_dict[name.strip()] = float(scale.strip())
-            except ValueError:
-                print(f"Warning: Invalid LoRA scale '{scale}' for '{name}', skipping")
-    
-    return lora_dict
+    return dict(_parse_lora_pairs(lora_string))